@@ -1,8 +1,21 @@
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI
+import asyncio
+import functools
+import hashlib
+import mmap
+import multiprocessing
 import os
+import queue
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
-import PyPDF2
-import json
+import pymupdf
+import orjson
+import httpx
+from jsonschema import Draft202012Validator, ValidationError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 load_dotenv()
 
@@ -24,6 +37,7 @@ toc_schema = {
 
 # MODIFIED: The schema for a SINGLE proceeding item, not the whole document
 # We remove the outer structure and just define the "items" part of the original "proceedings" array.
+# Sub-schemas stay inline rather than in "$defs": each is used once, so "$ref" would only add bytes.
 proceeding_item_schema = {
     "type": "object",
     "properties": {
@@ -79,137 +93,574 @@ proceeding_item_schema = {
     "required": ["type", "title", "summary", "key_topics"]
 }
 
+# Document-level metadata, read from the cover pages
+metadata_schema = {
+    "type": "object",
+    "properties": {
+        "chamber": {"type": "string", "description": "The chamber, e.g. 'SENATE' or 'HOUSE OF REPRESENTATIVES'."},
+        "date": {"type": "string", "description": "The sitting date in YYYY-MM-DD format."},
+        "parliament_session": {"type": "string", "description": "The parliament and session, e.g. 'FORTY-EIGHTH PARLIAMENT, FIRST SESSION'."}
+    },
+    "required": ["chamber", "date", "parliament_session"]
+}
+
+# Several short proceedings can be parsed in a single call; the model returns one item per segment.
+# Strict structured outputs need an object at the root, so the list sits under "proceedings".
+proceeding_batch_schema = {
+    "type": "object",
+    "properties": {
+        "proceedings": {
+            "type": "array",
+            "description": "One parsed proceeding per input segment, in the same order as the segments.",
+            "items": proceeding_item_schema
+        }
+    },
+    "required": ["proceedings"]
+}
+
+_SCHEMAS = {
+    "toc_parser": toc_schema,
+    "proceeding_parser": proceeding_item_schema,
+    "proceeding_batch_parser": proceeding_batch_schema,
+    "metadata_parser": metadata_schema,
+}
+
+def _build_response_format(schema, schema_name):
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": schema_name,
+            "strict": True,
+            "schema": schema
+        }
+    }
+
+# Schemas are static, so their validators, JSON encodings and response_format
+# objects are built once here and reused for every call, keyed by schema name
+_VALIDATORS = {name: Draft202012Validator(schema) for name, schema in _SCHEMAS.items()}
+_SCHEMA_JSON = {name: orjson.dumps(schema, option=orjson.OPT_SORT_KEYS).decode() for name, schema in _SCHEMAS.items()}
+_RESPONSE_FORMATS = {name: _build_response_format(schema, name) for name, schema in _SCHEMAS.items()}
+_JSON_OBJECT_FORMAT = {"type": "json_object"}
+MAX_VALIDATION_ATTEMPTS = 2 # Re-ask the model if its output doesn't match the schema
+
 # --- Helper Functions ---
 
-def extract_text_from_pdf_pages(pdf_path, start_page=None, end_page=None):
-    """Extract text from a specific range of pages in a PDF file"""
-    text = ""
-    page_texts = {}
-    try:
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            num_pages = len(pdf_reader.pages)
-            
-            # Use 1-based indexing for user-friendliness, convert to 0-based for PyPDF2
-            start = (start_page - 1) if start_page else 0
-            end = (end_page) if end_page else num_pages
-            
+# Match model capacity to the task: the ToC and short proceedings don't need the large model
+MODEL_TOC = "meta-llama/llama-3.1-8b-instruct:free"
+MODEL_PROC_SMALL = "meta-llama/llama-3.1-8b-instruct:free"
+MODEL_PROC_LARGE = "qwen/qwen3-235b-a22b:free"
+SMALL_PROCEEDING_CHARS = 4000 # Proceedings with less text than this go, unbatched, to MODEL_PROC_SMALL
+CACHE_DIR = "cache" # LLM responses are stored here so reruns on unchanged input skip the API
+
+PAGES_PER_WORKER_CHUNK = 10 # Pages handed to each extraction worker at a time
+# Worker start-up (re-importing this module) costs ~1s, against ~2ms per page in-process,
+# so the pool only pays off on very large documents
+PARALLEL_MIN_PAGES = 500
+
+HEADER_REGION_LINES = 4 # Running headers (chamber, date, page number) sit in the first few lines of a page
+BOILERPLATE_MIN_PAGES = 3 # A header line repeated on this many pages is treated as boilerplate
+
+# A bare arabic page number, or a well-formed lowercase roman numeral as used in the front matter
+_PAGE_NUMBER_RE = re.compile(r"^(\d+|(?=[ivxlcdm])m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3}))$")
+_LINE_BREAK_HYPHEN_RE = re.compile(r"(\w)-\n(\w)")
+_DOT_LEADER_RE = re.compile(r"\.{4,}")
+_MULTI_SPACE_RE = re.compile(r"[ \t]{2,}")
+_TRAILING_SPACE_RE = re.compile(r"[ \t]+\n")
+
+def find_boilerplate_lines(page_texts, min_pages=BOILERPLATE_MIN_PAGES):
+    """Return the header lines that repeat across at least min_pages pages."""
+    counts = {}
+    for page_text in page_texts.values():
+        for line in set(line.strip() for line in page_text.splitlines()[:HEADER_REGION_LINES]):
+            counts[line] = counts.get(line, 0) + 1
+    return {line for line, count in counts.items() if line and count >= min_pages}
+
+def clean_page_text(page_text, boilerplate):
+    """Strip running headers and page numbers from a page, then collapse extraction artifacts."""
+    lines = [line.strip() for line in page_text.splitlines()]
+    kept = []
+    for i, line in enumerate(page_text.splitlines()):
+        if i < HEADER_REGION_LINES and lines[i] in boilerplate:
+            continue
+        # A page number is only dropped where running headers put it: first or last line, or next to a header line,
+        # so numbers that are real content (e.g. division tallies) survive
+        if _PAGE_NUMBER_RE.match(lines[i]):
+            next_to_header = (i > 0 and lines[i - 1] in boilerplate) or (i + 1 < len(lines) and lines[i + 1] in boilerplate)
+            if i == 0 or i == len(lines) - 1 or (i < HEADER_REGION_LINES and next_to_header):
+                continue
+        kept.append(line)
+    text = "\n".join(kept) + "\n"
+    # Hansard hyphens are almost always real compounds ("wall-to-wall"), so keep the hyphen and drop only the break
+    text = _LINE_BREAK_HYPHEN_RE.sub(r"\1-\2", text)
+    text = _DOT_LEADER_RE.sub(" ... ", text)
+    text = _MULTI_SPACE_RE.sub(" ", text)
+    return _TRAILING_SPACE_RE.sub("\n", text)
+
+def _get_max_workers(n_chunks):
+    """Number of extraction processes to use, capped by the available work."""
+    return max(1, min(os.cpu_count() or 1, n_chunks))
+
+def _get_mp_context():
+    """Start method for extraction workers.
+
+    The pool is created on PageStream's extractor thread, and forking a
+    multi-threaded process can deadlock, so prefer forkserver and fall back to
+    spawn where forkserver isn't available (e.g. Windows).
+    """
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(start_method)
+
+def _extract_range(pdf_path, lo, hi):
+    """Worker: extract pages [lo, hi) (0-based) and return them keyed by 1-based page number."""
+    with pymupdf.open(pdf_path) as doc:
+        return {page_num + 1: doc[page_num].get_text("text") for page_num in range(lo, hi)}
+
+def iter_pdf_pages(pdf_path, start_page=None, end_page=None):
+    """Yield (page_number, text) pairs in document order, extracting slices of pages in parallel for large documents."""
+    with pymupdf.open(pdf_path) as doc:
+        num_pages = doc.page_count
+
+        # Use 1-based indexing for user-friendliness, convert to 0-based for PyMuPDF
+        start = (start_page - 1) if start_page else 0
+        end = min(end_page, num_pages) if end_page else num_pages
+
+        # Starting worker processes costs more than extracting a typical Hansard in-process
+        if end - start < PARALLEL_MIN_PAGES:
             for page_num in range(start, end):
-                if page_num < num_pages:
-                    page = pdf_reader.pages[page_num]
-                    page_text = page.extract_text()
-                    page_texts[page_num + 1] = page_text # Store with 1-based page number
-                    text += page_text + "\n"
-                
-    except Exception as e:
-        print(f"Error reading PDF: {e}")
-        return None, None
-    
-    return text, page_texts
-
-def get_llm_response(client, system_prompt, user_prompt, schema, schema_name):
-    """Generic function to call the LLM with a JSON schema."""
-    try:
-        completion = client.chat.completions.create(
-            model="qwen/qwen3-235b-a22b:free", # Using a cheaper, faster model for chunked processing is often sufficient
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            response_format={
-                "type": "json_schema",
-                "json_schema": {
-                    "name": schema_name,
-                    "strict": True,
-                    "schema": schema
-                }
-            },
+                yield page_num + 1, doc[page_num].get_text("text")
+            return
+
+    # Each worker reopens the PDF and extracts its own slice of pages
+    ranges = [(lo, min(lo + PAGES_PER_WORKER_CHUNK, end)) for lo in range(start, end, PAGES_PER_WORKER_CHUNK)]
+    with ProcessPoolExecutor(max_workers=_get_max_workers(len(ranges)), mp_context=_get_mp_context()) as executor:
+        futures = [executor.submit(_extract_range, pdf_path, lo, hi) for lo, hi in ranges]
+        # Yield in submission order so pages stay in document order
+        for future in futures:
+            yield from future.result().items()
+
+class PageStream:
+    """Extracts a PDF on a background thread and collects pages as they arrive.
+
+    Coroutines can await a particular page while extraction carries on, so LLM
+    calls can start before the whole document has been read.
+    """
+
+    def __init__(self, pdf_path, maxsize):
+        self.pdf_path = pdf_path
+        self.pages = {}
+        self.done = False
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._changed = None
+        self._drain_task = None
+
+    def start(self):
+        """Start the extractor thread and the task that drains its queue. Must run inside the event loop."""
+        self._changed = asyncio.Condition()
+        threading.Thread(target=self._produce, daemon=True).start()
+        # The event loop only holds weak references to tasks, so keep this one alive here
+        self._drain_task = asyncio.create_task(self._drain())
+
+    def _produce(self):
+        try:
+            for page in iter_pdf_pages(self.pdf_path):
+                self._queue.put(page)
+        except Exception as e:
+            print(f"Error reading PDF: {e}")
+        finally:
+            self._queue.put(None) # Sentinel: extraction finished
+
+    async def _drain(self):
+        while True:
+            page = await asyncio.to_thread(self._queue.get)
+            async with self._changed:
+                if page is None:
+                    self.done = True
+                else:
+                    self.pages[page[0]] = page[1]
+                self._changed.notify_all()
+            if page is None:
+                return
+
+    async def wait_for(self, page_num):
+        """Wait until page_num has been extracted. Returns False if the document ended first."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.done or page_num in self.pages)
+        return page_num in self.pages
+
+    async def wait_all(self):
+        """Wait until every page has been extracted."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.done)
+        return self.pages
+
+def _schema_json(schema, schema_name):
+    """The JSON encoding of a schema, precomputed for the known schemas."""
+    return _SCHEMA_JSON.get(schema_name) or orjson.dumps(schema, option=orjson.OPT_SORT_KEYS).decode()
+
+LLM_TIMEOUT_SECONDS = 60.0 # Per-call timeout, so a hung request is retried instead of stalling the run
+LLM_MAX_ATTEMPTS = 5
+# Rate limits, timeouts, dropped connections and 5xx are transient; other 4xx errors won't succeed on retry
+_RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+class InvalidLLMOutput(Exception):
+    """The model's reply was not valid JSON or didn't match the schema, even after retrying."""
+
+def _log_retry(retry_state):
+    print(f"LLM API Error: {retry_state.outcome.exception()} (attempt {retry_state.attempt_number}/{LLM_MAX_ATTEMPTS}), retrying...")
+
+@retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(LLM_MAX_ATTEMPTS),
+    retry=retry_if_exception_type(_RETRYABLE_ERRORS),
+    before_sleep=_log_retry,
+    reraise=True,
+)
+async def _stream_completion(client, model, system_prompt, user_prompt, response_format):
+    """Stream one completion and return its full text, retrying transient API errors with backoff."""
+    stream = await client.with_options(timeout=LLM_TIMEOUT_SECONDS).chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        response_format=response_format,
+        stream=True,
+    )
+    # Accumulate streamed deltas; the JSON is only parseable once the response finishes.
+    # Closing the stream releases its connection back to the pool as soon as we stop reading.
+    content_parts = []
+    async with stream:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                content_parts.append(delta)
+            if chunk.choices[0].finish_reason:
+                break
+    return "".join(content_parts)
+
+def cached_llm_response(func):
+    """Cache successful LLM responses on disk, keyed by prompt, schema and model."""
+    @functools.wraps(func)
+    async def wrapper(client, system_prompt, user_prompt, schema, schema_name, model, **kwargs):
+        key_source = "\n".join([system_prompt, user_prompt, schema_name, _schema_json(schema, schema_name), repr(sorted(kwargs.items())), model])
+        key = hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+        cache_path = os.path.join(CACHE_DIR, f"{key}.json")
+
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return orjson.loads(f.read())
+
+        result = await func(client, system_prompt, user_prompt, schema, schema_name, model, **kwargs)
+        if result is not None:
+            # Write to a temp file then rename, so an interrupted run never leaves a partial entry
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(orjson.dumps(result))
+            os.replace(tmp_path, cache_path)
+        return result
+    return wrapper
+
+@cached_llm_response
+async def get_llm_response(client, system_prompt, user_prompt, schema, schema_name, model, strict=True, result_key=None, expected_items=None):
+    """Generic function to call the LLM with a JSON schema.
+
+    With strict=False the schema is described in the system prompt and the
+    lighter json_object mode is used, which avoids constrained decoding for
+    simple shapes. The model wraps its answer in {"result": ...}, which is
+    unwrapped before validation.
+
+    If result_key is given, the validated response is unwrapped to that key.
+    If expected_items is given, a list response of any other length counts as
+    invalid output, so it is retried and never cached.
+
+    Transient API errors are retried with backoff and other API errors are
+    raised. Output that is still malformed or invalid after
+    MAX_VALIDATION_ATTEMPTS raises InvalidLLMOutput.
+    """
+    validator = _VALIDATORS.get(schema_name)
+    if strict:
+        response_format = _RESPONSE_FORMATS.get(schema_name) or _build_response_format(schema, schema_name)
+    else:
+        response_format = _JSON_OBJECT_FORMAT
+        system_prompt = (
+            f"{system_prompt}\n\nRespond only with a JSON object of the form {{\"result\": ...}}, "
+            f"where the value of \"result\" matches this JSON schema:\n{_schema_json(schema, schema_name)}"
         )
-        return json.loads(completion.choices[0].message.content)
-    except Exception as e:
-        print(f"LLM API Error: {e}")
-        return None
+
+    for attempt in range(1, MAX_VALIDATION_ATTEMPTS + 1):
+        content = await _stream_completion(client, model, system_prompt, user_prompt, response_format)
+        try:
+            parsed = orjson.loads(content)
+            if not strict:
+                parsed = parsed.get("result") if isinstance(parsed, dict) else parsed
+            # The model doesn't always honour strict mode, so check the output locally
+            if validator:
+                validator.validate(parsed)
+            if result_key:
+                parsed = parsed[result_key]
+            if expected_items is not None and len(parsed) != expected_items:
+                raise ValidationError(f"expected {expected_items} items, got {len(parsed)}")
+            return parsed
+        except (orjson.JSONDecodeError, ValidationError) as e:
+            message = e.message if isinstance(e, ValidationError) else str(e)
+            print(f"Invalid response for {schema_name} (attempt {attempt}/{MAX_VALIDATION_ATTEMPTS}): {message}")
+            if attempt == MAX_VALIDATION_ATTEMPTS:
+                raise InvalidLLMOutput(message) from e
+
+async def bounded_call(sem, client, system_prompt, user_prompt, schema, schema_name, model, **kwargs):
+    """Call the LLM while holding a semaphore slot, to stay within rate limits."""
+    async with sem:
+        return await get_llm_response(client, system_prompt, user_prompt, schema, schema_name, model, **kwargs)
+
+CHARS_PER_TOKEN = 4 # Rough estimate, good enough for sizing batches
+
+async def pack_chunks(chunks, max_batch_tokens):
+    """Greedily group consecutive chunks so each group stays under the token budget.
+
+    Chunks routed to the small model are yielded on their own: a multi-segment
+    batch is the harder instruction-following task, so only the large model
+    gets those. Batches are yielded as soon as they are closed, so they can be
+    sent while later chunks are still waiting on extraction.
+    """
+    current = []
+    current_tokens = 0
+    async for chunk in chunks:
+        if choose_proc_model(chunk) == MODEL_PROC_SMALL:
+            yield [chunk]
+            continue
+        chunk_tokens = len(chunk[2]) // CHARS_PER_TOKEN
+        if current and current_tokens + chunk_tokens > max_batch_tokens:
+            yield current
+            current = []
+            current_tokens = 0
+        current.append(chunk)
+        current_tokens += chunk_tokens
+    if current:
+        yield current
+
+async def iter_chunks(parsed_toc, pages, boilerplate):
+    """Yield (sequence_id, item, chunk_text) for each ToC item once all of its pages are available."""
+    for i, item in enumerate(parsed_toc):
+        start_page = item['page_start']
+        # Determine end page by looking at the next item, or end of document for the last item
+        if i + 1 < len(parsed_toc):
+            end_page = parsed_toc[i + 1]['page_start'] - 1
+            await pages.wait_for(end_page)
+        else:
+            end_page = max(await pages.wait_all(), default=0)
+
+        print(f"  - Queueing '{item['title']}' (Pages {start_page}-{end_page})...")
+
+        # Concatenate the text for the relevant pages, minus the running headers
+        chunk_text = "".join(clean_page_text(pages.pages.get(page_num, ""), boilerplate) for page_num in range(start_page, end_page + 1))
+
+        if not chunk_text.strip():
+            print(f"    - WARNING: No text found for pages {start_page}-{end_page}. Skipping.")
+            continue
+
+        # Sequence ID comes from ToC order, not arrival order
+        yield (i + 1, item, chunk_text)
+
+def choose_proc_model(chunk):
+    """Pick the small model for a short proceeding and the large one otherwise."""
+    return MODEL_PROC_SMALL if len(chunk[2]) < SMALL_PROCEEDING_CHARS else MODEL_PROC_LARGE
+
+async def process_single(sem, client, chunk, model):
+    """Parse one (sequence_id, item, chunk_text) chunk on its own."""
+    sequence_id, item, chunk_text = chunk
+    proc_user_prompt = f"Hansard Segment Text:\n\n{chunk_text}"
+    parsed = await bounded_call(sem, client, PROC_SYSTEM_PROMPT, proc_user_prompt, proceeding_item_schema, "proceeding_parser", model)
+    return (sequence_id, item, parsed)
+
+async def process_batch(sem, client, batch):
+    """Parse a batch of (sequence_id, item, chunk_text) chunks, returning (sequence_id, item, parsed) per chunk."""
+    if len(batch) == 1:
+        return [await process_single(sem, client, batch[0], choose_proc_model(batch[0]))]
+
+    segments = [f"=== SEGMENT {n} ===\n{chunk_text}" for n, (_, _, chunk_text) in enumerate(batch, start=1)]
+    batch_user_prompt = f"Hansard Segments ({len(batch)} in total):\n\n" + "\n\n".join(segments)
+    try:
+        parsed = await bounded_call(sem, client, PROC_BATCH_SYSTEM_PROMPT, batch_user_prompt, proceeding_batch_schema, "proceeding_batch_parser", MODEL_PROC_LARGE, result_key="proceedings", expected_items=len(batch))
+        return [(sequence_id, item, result) for (sequence_id, item, _), result in zip(batch, parsed)]
+    except InvalidLLMOutput as e:
+        print(f"    - WARNING: Batch of {len(batch)} segments failed ({e}); parsing each segment separately.")
+
+    # Fall back to one call per segment, so one bad batch answer doesn't drop every proceeding in it
+    results = await asyncio.gather(*(process_single(sem, client, chunk, choose_proc_model(chunk)) for chunk in batch), return_exceptions=True)
+    fallback = []
+    for (sequence_id, item, _), result in zip(batch, results):
+        if isinstance(result, BaseException):
+            print(f"    - ERROR: {result}")
+            result = (sequence_id, item, None)
+        fallback.append(result)
+    return fallback
+
+async def process_and_record(sem, client, batch, jsonl_path):
+    """Process a batch and append each parsed proceeding to jsonl_path as soon as it completes."""
+    recorded = []
+    for sequence_id, item, parsed_proceeding in await process_batch(sem, client, batch):
+        print(parsed_proceeding)
+
+        if parsed_proceeding:
+            # Add the sequence ID from the ToC order
+            parsed_proceeding['sequence_id'] = sequence_id
+            recorded.append(parsed_proceeding)
+        else:
+            print(f"    - FAILED to parse proceeding: {item['title']}")
+
+    # Append-only, so a crash mid-run keeps everything finished so far
+    with open(jsonl_path, 'ab') as f:
+        for parsed_proceeding in recorded:
+            f.write(orjson.dumps(parsed_proceeding, option=orjson.OPT_APPEND_NEWLINE))
+    return recorded
+
+def pdf_file_hash(pdf_path):
+    """Content hash of a PDF, so memoized results follow the file rather than its path."""
+    with open(pdf_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.md5().hexdigest() # mmap can't map an empty file
+        # Hash straight from the mapped pages instead of copying the file through read() buffers
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.md5(mm).hexdigest()
+
+# lru_cache can't memoize a coroutine (its result can only be awaited once), so metadata is memoized here by file hash
+_METADATA_BY_FILE_HASH = {}
+
+async def get_metadata(client, pdf_hash, metadata_text):
+    """Extract document metadata from the cover pages, once per distinct PDF."""
+    if pdf_hash not in _METADATA_BY_FILE_HASH:
+        metadata_user_prompt = f"Cover Pages Text:\n\n{metadata_text}"
+        _METADATA_BY_FILE_HASH[pdf_hash] = await get_llm_response(client, METADATA_SYSTEM_PROMPT, metadata_user_prompt, metadata_schema, "metadata_parser", MODEL_TOC, strict=False)
+    return _METADATA_BY_FILE_HASH[pdf_hash]
+
+async def warm_up_connection(http_client, base_url):
+    """Establish a pooled connection ahead of the first real request; the response itself is ignored."""
+    try:
+        await http_client.head(base_url)
+    except httpx.HTTPError:
+        pass
 
 # --- Main Logic ---
 
 pdf_file_path = "documents/Senate_2025_09_04.pdf"
-client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=os.getenv("OPENROUTER_API_KEY"))
-
-# STEP 1: Extract and Parse Table of Contents (e.g., pages 11-14)
-print("Step 1: Parsing Table of Contents...")
-toc_text, _ = extract_text_from_pdf_pages(pdf_file_path, start_page=1, end_page=20)
-if not toc_text:
-    exit("Failed to extract ToC text.")
-
-toc_system_prompt = "Extract the proceedings from this Table of Contents. Ignore page headers/footers. List each main item with its starting page number."
-toc_user_prompt = f"Table of Contents Text:\n\n{toc_text}"
-parsed_toc = get_llm_response(client, toc_system_prompt, toc_user_prompt, toc_schema, "toc_parser")
-
-if not parsed_toc:
-    exit("Failed to parse the Table of Contents.")
-print(f"Successfully parsed {len(parsed_toc)} items from the ToC.")
-
-print(parsed_toc)
-
-# STEP 2: Process each proceeding individually
-print("\nStep 2: Processing each proceeding...")
-_, all_page_texts = extract_text_from_pdf_pages(pdf_file_path) # Get all text, indexed by page number
-if not all_page_texts:
-    exit("Failed to extract full text.")
-
-all_proceedings = []
-for i, item in enumerate(parsed_toc):
-    start_page = item['page_start']
-    # Determine end page by looking at the next item, or end of document for the last item
-    end_page = parsed_toc[i + 1]['page_start'] - 1 if i + 1 < len(parsed_toc) else len(all_page_texts)
-    
-    print(f"  - Processing '{item['title']}' (Pages {start_page}-{end_page})...")
-    
-    # Concatenate the text for the relevant pages
-    chunk_text = ""
-    for page_num in range(start_page, end_page + 1):
-        chunk_text += all_page_texts.get(page_num, "")
-
-    if not chunk_text.strip():
-        print(f"    - WARNING: No text found for pages {start_page}-{end_page}. Skipping.")
-        continue
-    
-    proc_system_prompt = "You are an expert parliamentary analyst. Parse the following Hansard segment and structure the information according to the JSON schema."
-    proc_user_prompt = f"Hansard Segment Text:\n\n{chunk_text}"
-    
-    # This is the call for a single chunk
-    parsed_proceeding = get_llm_response(client, proc_system_prompt, proc_user_prompt, proceeding_item_schema, "proceeding_parser")
-
-    print(parsed_proceeding)
-    
-    if parsed_proceeding:
-        # Add the sequence ID from our loop
-        parsed_proceeding['sequence_id'] = i + 1
-        all_proceedings.append(parsed_proceeding)
-    else:
-        print(f"    - FAILED to parse proceeding: {item['title']}")
+# The ToC is expected somewhere within the first pages. Running headers are also learned only from
+# this window, so it must reach at least BOILERPLATE_MIN_PAGES body pages past the front matter.
+TOC_LAST_PAGE = 20
+METADATA_LAST_PAGE = 3 # Chamber, date and session are all on the cover pages
+METADATA_SYSTEM_PROMPT = "Extract the chamber, sitting date and parliament session from these Hansard cover pages."
+PARTIAL_OUTPUT_PATH = "hansard_summary.jsonl" # Completed proceedings are appended here as they arrive
+PAGE_QUEUE_SIZE = 50 # Backpressure between the extractor thread and the event loop
+MAX_CONCURRENT_REQUESTS = 10 # Upper bound on in-flight LLM calls
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+# Keep connections alive between calls so each request doesn't pay a fresh TLS handshake
+HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=50, keepalive_expiry=60.0)
+MAX_BATCH_TOKENS = 6000 # Consecutive short proceedings are packed into one call up to this size
+PROC_SYSTEM_PROMPT = "You are an expert parliamentary analyst. Parse the following Hansard segment and structure the information according to the JSON schema."
+PROC_BATCH_SYSTEM_PROMPT = "You are an expert parliamentary analyst. The input contains several Hansard segments, each starting with a '=== SEGMENT n ===' line. Parse each segment separately and return exactly one object per segment, in the same order, structured according to the JSON schema."
 
+async def main():
+    # HTTP/2 multiplexes the concurrent calls over a few pooled connections
+    async with httpx.AsyncClient(http2=True, limits=HTTP_LIMITS) as http_client:
+        # Retries are handled by _stream_completion, so the client's own retry loop is disabled
+        client = AsyncOpenAI(base_url=OPENROUTER_BASE_URL, api_key=os.getenv("OPENROUTER_API_KEY"), http_client=http_client, max_retries=0)
+        # Open the connection while the PDF is being extracted, so the first LLM call finds it ready
+        warmup_task = asyncio.create_task(warm_up_connection(http_client, OPENROUTER_BASE_URL))
+        try:
+            # Pages are extracted once on a background thread; later steps read from pages.pages as they arrive
+            pages = PageStream(pdf_file_path, PAGE_QUEUE_SIZE)
+            pages.start()
 
-# STEP 3: Assemble the Final JSON
-print("\nStep 3: Assembling final JSON document...")
+            # STEP 1: Extract and Parse Table of Contents (e.g., pages 11-14)
+            print("Step 1: Parsing Table of Contents...")
+            await pages.wait_for(TOC_LAST_PAGE)
+            # Learn the running headers once from a fixed window, so prompts (and cache keys) don't depend on extraction timing
+            toc_pages = {p: pages.pages[p] for p in range(1, TOC_LAST_PAGE + 1) if p in pages.pages}
+            boilerplate = find_boilerplate_lines(toc_pages)
+            toc_text = "\n".join(clean_page_text(page_text, boilerplate) for page_text in toc_pages.values())
+            if not toc_text.strip():
+                exit("Failed to extract ToC text.")
 
-# Extract metadata (usually from the first page)
-metadata_text, _ = extract_text_from_pdf_pages(pdf_file_path, start_page=1, end_page=1)
-# (For simplicity, we'll hardcode it, but you could use another small LLM call to extract this)
-final_metadata = {
-    "chamber": "SENATE",
-    "date": "2025-09-04",
-    "parliament_session": "FORTY-EIGHTH PARLIAMENT, FIRST SESSION"
-}
+            # Hash off the event loop; the file was just read, so this is served from the page cache
+            try:
+                pdf_hash = await asyncio.to_thread(pdf_file_hash, pdf_file_path)
+            except OSError as e:
+                print(f"Error reading PDF: {e}")
+                exit("Failed to hash the PDF.")
 
-final_json = {
-    "document_metadata": final_metadata,
-    "proceedings": all_proceedings
-}
+            # The rest of the document keeps extracting while the ToC call is in flight.
+            # The ToC shape is trivial, so skip constrained decoding and validate locally instead.
+            toc_system_prompt = "Extract the proceedings from this Table of Contents. Ignore page headers/footers. List each main item with its starting page number."
+            toc_user_prompt = f"Table of Contents Text:\n\n{toc_text}"
+            try:
+                parsed_toc = await get_llm_response(client, toc_system_prompt, toc_user_prompt, toc_schema, "toc_parser", MODEL_TOC, strict=False)
+            except Exception as e:
+                exit(f"Failed to parse the Table of Contents: {e}")
+
+            if not parsed_toc:
+                exit("Failed to parse the Table of Contents.")
+            print(f"Successfully parsed {len(parsed_toc)} items from the ToC.")
+
+            print(parsed_toc)
+
+            # Metadata only needs the cover pages, so fetch it alongside the proceedings
+            metadata_text = "\n".join(pages.pages[p] for p in range(1, METADATA_LAST_PAGE + 1) if p in pages.pages)
+            metadata_task = asyncio.create_task(get_metadata(client, pdf_hash, metadata_text))
+
+            # STEP 2: Process each proceeding concurrently
+            print("\nStep 2: Processing each proceeding...")
+            sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+            # Start each run with an empty partial-progress file
+            open(PARTIAL_OUTPUT_PATH, 'w', encoding='utf-8').close()
+
+            # Short proceedings share a call; each batch is sent as soon as its pages are available
+            batches = []
+            tasks = []
+            async for batch in pack_chunks(iter_chunks(parsed_toc, pages, boilerplate), MAX_BATCH_TOKENS):
+                batches.append(batch)
+                tasks.append(asyncio.create_task(process_and_record(sem, client, batch, PARTIAL_OUTPUT_PATH)))
+            print(f"  - Sent {sum(len(batch) for batch in batches)} proceedings in {len(batches)} requests...")
+
+            # A failed batch doesn't abort the rest
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+
+            all_proceedings = []
+            for batch, batch_results in zip(batches, results):
+                if isinstance(batch_results, BaseException):
+                    print(f"    - ERROR: {batch_results}")
+                    for _, item, _ in batch:
+                        print(f"    - FAILED to parse proceeding: {item['title']}")
+                    continue
+                all_proceedings.extend(batch_results)
+            # Batches finish in any order; restore ToC order for the final document
+            all_proceedings.sort(key=lambda proceeding: proceeding['sequence_id'])
+
+
+            # STEP 3: Assemble the Final JSON
+            print("\nStep 3: Assembling final JSON document...")
+
+            try:
+                final_metadata = await metadata_task
+            except Exception as e:
+                print(f"    - WARNING: Failed to extract document metadata: {e}")
+                final_metadata = {"chamber": None, "date": None, "parliament_session": None}
+
+            final_json = {
+                "document_metadata": final_metadata,
+                "proceedings": all_proceedings
+            }
+
+            # Save to file
+            output_path = "hansard_summary.json"
+            with open(output_path, 'wb') as f:
+                f.write(orjson.dumps(final_json, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        finally:
+            warmup_task.cancel()
 
-# Save to file
-output_path = "hansard_summary.json"
-with open(output_path, 'w', encoding='utf-8') as f:
-    json.dump(final_json, f, ensure_ascii=False, indent=2)
+    print(f"\nProcessing complete! Structured summary saved to {output_path}")
 
-print(f"\nProcessing complete! Structured summary saved to {output_path}")
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())